@@ -1,9 +1,22 @@
 #!/usr/bin/python2
 
 import os
+import time
+import logging
 import httplib2
 import keyring
+import requests
+import urllib3
+from threading import Thread, Lock, Event
 from oauth2client.client import OAuth2WebServerFlow
+from google.auth import _helpers
+from google.auth.transport.requests import Request
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger('gbd')
+
+# raised by SessionHttp, including while reading a streamed body
+TRANSPORT_ERRORS = (requests.RequestException, urllib3.exceptions.HTTPError)
 
 class AuthManager:
 
@@ -33,7 +46,95 @@ class AuthManager:
         credentials = self.request_credentials()
         return credentials
 
-    def get_auth_http(self, credentials=None):
-        if not credentials or credentials.invalid:
-            credentials = self.get_credentials()
-        return credentials.authorize(httplib2.Http())
+# Shares one set of credentials between all workers and refreshes the token
+# in the background shortly before it expires.
+class TokenManager(Thread):
+
+    # credentials.valid turns false this long before expiry (REFRESH_THRESHOLD
+    # in current google-auth, CLOCK_SKEW in older ones); refresh a minute
+    # earlier so workers never see invalid credentials and refresh inline
+    REFRESH_MARGIN = getattr(_helpers, 'REFRESH_THRESHOLD', _helpers.CLOCK_SKEW).total_seconds() + 60
+    RETRY_DELAY = 30
+
+    def __init__(self, credentials):
+        Thread.__init__(self)
+        self.daemon = True
+        self.credentials = credentials
+        self.lock = Lock()
+        self.inflight = None
+
+    def token(self):
+        if not self.credentials.valid:
+            self.refresh()
+        return self.credentials.token
+
+    def refresh(self):
+        with self.lock:
+            done = self.inflight
+            leader = done is None
+            if leader:
+                done = self.inflight = Event()
+        if not leader:
+            done.wait()
+            return
+        try:
+            logger.info("Refreshing access token")
+            self.credentials.refresh(Request())
+        finally:
+            with self.lock:
+                self.inflight = None
+            done.set()
+
+    def run(self):
+        while self.credentials.expiry is not None:
+            remain = self.credentials.expiry - _helpers.utcnow()
+            delay = remain.total_seconds() - self.REFRESH_MARGIN
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error("Token refresh failed: {0}".format(e))
+                time.sleep(self.RETRY_DELAY)
+
+# googleapiclient expects an httplib2-like object; this one forwards to a
+# pooled requests session so connections are kept alive between requests.
+class SessionHttp:
+
+    def __init__(self, tokens, pool_size=8, timeout=60):
+        self.tokens = tokens
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False)
+        self.session.mount('https://', adapter)
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        r = self.send(uri, method, body, headers, redirections > 0)
+        return self.response(r), r.content
+
+    def stream(self, uri, headers=None):
+        return self.send(uri, headers=headers, stream=True)
+
+    def send(self, uri, method='GET', body=None, headers=None, redirect=True, stream=False):
+        headers = dict(headers or {})
+        for retry in (True, False):
+            headers['authorization'] = 'Bearer {0}'.format(self.tokens.token())
+            r = self.session.request(method, uri, data=body, headers=headers,
+                    allow_redirects=redirect, timeout=self.timeout, stream=stream)
+            if r.status_code != 401 or not retry:
+                break
+            r.close()
+            self.tokens.refresh()
+        return r
+
+    @staticmethod
+    def response(r):
+        info = dict(r.headers)
+        info['status'] = str(r.status_code)
+        resp = httplib2.Response(info)
+        resp.reason = r.reason
+        return resp
+
+    def close(self):
+        self.session.close()
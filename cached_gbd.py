@@ -16,9 +16,6 @@ class CachedGBD:
 
     def __init__(self, cache_file, dirty=False, *args, **kargs):
 
-        if 'workers' not in kargs:
-            kargs['workers'] = 16
-
         self.done = False
 
         self.gbd = GBD(*args, **kargs)
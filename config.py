@@ -14,5 +14,11 @@ Config = {
     'oauth_redirect_uri': 'urn:ietf:wg:oauth:2.0:oob',
 
     'gbd_data_folder': 'W-GBD_DATA',
+    'state_dir': '~/.gbd',
+
+    'workers': 32,
+    'cache_blocks': 1024,
+    'readahead': 16,
+    'preallocate': False,
 
 }
@@ -6,6 +6,8 @@ import hashlib
 import logging
 import time
 import random
+import collections
+from io import BytesIO
 
 import os.path
 from googleapiclient.discovery import build
@@ -16,23 +18,76 @@ from google.oauth2.credentials import Credentials
 from threading import Thread, Lock, Semaphore
 from config import Config, Metadata
 from util import TimedPriorityQueue
-from auth import AuthManager
+from auth import SessionHttp, TokenManager, TRANSPORT_ERRORS
 from apiclient import errors as apierrors
 from apiclient.discovery import build as build_service
-from apiclient.http import MediaInMemoryUpload
+from apiclient.http import MediaInMemoryUpload, MediaIoBaseUpload
+
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
 
 logger = logging.getLogger('gbd')
 
+RETRY_STATUS = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+def _should_retry(e):
+    # an inner _with_backoff already spent its retries on this error
+    if getattr(e, 'backoff_exhausted', False):
+        return False
+    if e.resp.status in RETRY_STATUS:
+        return True
+    if e.resp.status == 403:
+        try:
+            reason = json_loads(e.content)['error']['errors'][0]['reason']
+        except (ValueError, KeyError, IndexError, TypeError):
+            return False
+        return reason in RATE_LIMIT_REASONS
+    return False
+
+def _with_backoff(fn, tries=5):
+    for rnd in range(tries):
+        try:
+            return fn()
+        except apierrors.HttpError as e:
+            if not _should_retry(e):
+                raise
+            if rnd == tries - 1:
+                e.backoff_exhausted = True
+                raise
+            delay = min(64, 2 ** rnd) + random.random()
+            logger.warning("Random backoff {0:.2f}s (HTTP {1})".format(delay, e.resp.status))
+            time.sleep(delay)
+
+def _upload(request):
+    if request.resumable is None:
+        return request.execute()
+    response = None
+    while response is None:
+        _, response = _with_backoff(request.next_chunk)
+    return response
+
 class GBDWorker(Thread):
 
-    def __init__(self, gbd, drive):
+    def __init__(self, gbd, http, drive):
         Thread.__init__(self)
         self.gbd = gbd
+        self.http = http
         self.drive = drive
 
     def run(self):
         while True:
             idx, data, cb = self.gbd.que.get()
+            if data is None and not self.gbd.start_read(cb):
+                # another copy of this read was queued at a higher priority
+                self.gbd.que.task_done()
+                continue
             err, ret = None, None
             try:
                 ret = self.do_request(idx, data)
@@ -49,73 +104,138 @@ class GBDWorker(Thread):
                     self.gbd.que.task_done()
 
     def do_request(self, idx, data):
-        for rnd in xrange(5):
-            try:
-                if data is None:
-                    return self.read_block(idx)
-                else:
-                    return self.write_block(idx, data)
-            except apierrors.HttpError as e:
-                if e.resp.status == 403:
-                    reason = json.loads(e.content)['error']['errors'][0]['reason']
-                    if reason in ['rateLimitExceeded', 'userRateLimitExceeded']:
-                        logger.warning("Random backoff ({0})".format(reason))
-                        time.sleep((2 ** rnd) + random.randint(0, 999) / 1000)
-                        continue
+        if data is None:
+            fn = lambda: self.read_block(idx)
+        elif data is self.gbd.ALLOCATE:
+            tried = [False]
+            def fn():
+                recheck, tried[0] = tried[0], True
+                return self.gbd.allocate_block(idx, recheck)
+        else:
+            fn = lambda: self.write_block(idx, data)
+        try:
+            return _with_backoff(fn)
+        except apierrors.HttpError as e:
+            # the mapping may come from a stale local state file
+            blkid = getattr(e, 'blkid', None)
+            if e.resp.status != 404 or blkid is None:
                 raise
+            self.gbd.forget_block(idx, blkid)
+            return _with_backoff(fn)
 
     def read_block(self, idx):
         blkid = self.gbd.block_id(idx)
         if blkid is None:
-            return "\0" * self.gbd.block_size
+            return self.gbd.zero_block
         else:
-            results = self.drive.files().get_media(fileId=blkid).execute()
-            assert len(results) == self.gbd.block_size
+            try:
+                results = self.fetch_media(blkid)
+            except apierrors.HttpError as e:
+                e.blkid = blkid
+                raise
+            except TRANSPORT_ERRORS as e:
+                logger.warning("Direct read of block {0} failed, falling back: {1}".format(idx, repr(e)))
+                results = self.drive.files().get_media(fileId=blkid).execute()
+            if len(results) != self.gbd.block_size:
+                raise IOError("Block {0} is {1} bytes, expected {2}".format(idx, len(results), self.gbd.block_size))
             return results
 
+    def fetch_media(self, blkid):
+        url = self.gbd.MEDIA_URL.format(blkid)
+        size = self.gbd.block_size
+        # identity encoding so Content-Length is the size of the block itself
+        with self.http.stream(url, headers={'accept-encoding': 'identity'}) as r:
+            if r.status_code != 200:
+                raise apierrors.HttpError(self.http.response(r), r.content, uri=url)
+            length = r.headers.get('content-length')
+            if length is not None and int(length) != size:
+                raise IOError("Block {0} is {1} bytes, expected {2}".format(blkid, length, size))
+            # chunked responses carry no length; reading one byte past the
+            # block is enough to tell an oversized body apart
+            return r.raw.read(size + 1)
+
     def write_block(self, idx, data):
         assert len(data) == self.gbd.block_size
         blkid = self.gbd.block_id(idx)
         if blkid is None:
             return self.gbd.new_block(idx, data)
         else:
-            media_body = MediaInMemoryUpload(data, mimetype=self.gbd.BLOCK_MIMETYPE, resumable=False)
-            return self.drive.files().update(fileId=blkid, media_body=media_body).execute()
+            media_body = self.gbd.media_body(data)
+            try:
+                return _upload(self.drive.files().update(fileId=blkid, media_body=media_body, fields="id"))
+            except apierrors.HttpError as e:
+                e.blkid = blkid
+                raise
 
 class GBD:
 
     FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
     BLOCK_MIMETYPE = 'application/octet-stream'
+    BLOCK_PREFIX = 'gbd_b'
+    RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+    UPLOAD_CHUNKSIZE = 4 * 1024 * 1024
+    LOCK_STRIPES = 64
+    # queued in place of data to create a block known to be absent
+    ALLOCATE = object()
+    MEDIA_URL = 'https://www.googleapis.com/drive/v3/files/{0}?alt=media&supportsAllDrives=true'
 
     def __init__(self, **config):
 
         self.config = Config.copy()
         self.config.update(config)
 
+        self.tokens = TokenManager(self.load_credentials())
+        self.tokens.start()
         self.drive = self.build_service()
 
-        self.data_dir = self.get_data_dir()
-        self.uuid = hashlib.sha1(self.data_dir).hexdigest()
-        self.load_data_dir()
+        self.fresh = False
+        self.data_dir_lock = Lock()
+        state = self.load_state()
+        # a data dir taken from local state is only checked once a cached id fails
+        self.data_dir_verified = not state
+        if state:
+            self.data_dir = state['data_dir']
+            self.bd_attr = state['bd_attr']
+        else:
+            self.data_dir = self.get_data_dir()
+            self.load_data_dir()
+        self.uuid = hashlib.sha1(self.data_dir.encode('utf-8')).hexdigest()
 
         self.block_size = self.bd_attr['block_size']
         self.block_count = self.bd_attr['block_count']
         self.total_size = self.block_size * self.block_count
         self.mapping = [None] * self.block_count
+        self.zero_block = bytes(self.block_size)
         self.que = TimedPriorityQueue()
-        self.lock = Lock()
+        self.locks = [Lock() for _ in range(self.LOCK_STRIPES)]
+        self._map_lock = Lock()
+        self._inflight_reads = {}
+        self._inflight_lock = Lock()
+        self._cache = collections.OrderedDict()
+        self._cache_size = self.config['cache_blocks']
+        self._cache_lock = Lock()
+        self._last_reads = collections.deque(maxlen=4)
 
         self.running = True
         self.workers = []
-        for i in xrange(self.config.get('workers', 8)):
-            worker = GBDWorker(self, self.build_service())
+        for i in range(self.config['workers']):
+            http = self.new_http()
+            worker = GBDWorker(self, http, self.build_service(http))
             worker.daemon = True
             worker.start()
             self.workers.append(worker)
 
+        if state:
+            self.mapping[:] = state['mapping']
+        else:
+            self._prime_mapping()
+        if self.fresh and self.config['preallocate']:
+            self.preallocate()
+        self.save_state()
+
     ## init
 
-    def build_service(self):
+    def load_credentials(self):
         SCOPES = ['https://www.googleapis.com/auth/drive']
         creds = None
     # The file token.json stores the user's access and refresh tokens, and is
@@ -134,16 +254,21 @@ class GBD:
         # Save the credentials for the next run
             with open('token.json', 'w') as token:
                 token.write(creds.to_json())
-        return  build('drive', 'v3', credentials=creds)
-        #return build_service('drive', 'v2', http=self.auth_mgr.get_auth_http())
+        return creds
+
+    def new_http(self):
+        return SessionHttp(self.tokens, pool_size=self.config['workers'])
+
+    def build_service(self, http=None):
+        return build('drive', 'v3', http=http or self.new_http())
 
     def get_data_dir(self):
 
         folder = self.config['gbd_data_folder']
-        query_str = "title='{0}'".format(folder)
+        query_str = "name='{0}' and trashed=false".format(folder)
 
-        results = self.drive.files().list(q=query_str).execute()
-        items = filter(lambda x: not x['labels']['trashed'], results['items'])
+        results = self.drive.files().list(q=query_str, fields="files(id,mimeType,capabilities/canEdit)").execute()
+        items = results['files']
         if len(items) == 0:
             if not self.config.get('create', False):
                 raise RuntimeError("Can't locate `{0}'".format(folder))
@@ -155,7 +280,7 @@ class GBD:
         item = items[0]
         if item['mimeType'] != self.FOLDER_MIMETYPE:
             raise AssertionError("`{0}' is not a folder!! (mimeType={1})".format(folder, item['mimeType']))
-        if not item['editable']:
+        if not item['capabilities']['canEdit']:
             raise RuntimeError("folder `{0}' is readonly!".format(folder))
 
         return item['id']
@@ -164,11 +289,11 @@ class GBD:
 
         folder = self.config['gbd_data_folder']
         body = {
-            'title': folder,
+            'name': folder,
             'parents': ['root'],
             'mimeType': self.FOLDER_MIMETYPE,
         }
-        result = self.drive.files().insert(body=body).execute()
+        result = self.drive.files().create(body=body, fields="id").execute()
 
         if not result:
             raise RuntimeError("Can't create folder `{0}'".format(folder))
@@ -176,19 +301,19 @@ class GBD:
 
     def load_data_dir(self):
 
-        query_str = "title='config'"
-        results = self.drive.children().list(folderId=self.data_dir, q=query_str).execute()
-        if len(results['items']) == 0:
+        query_str = "'{0}' in parents and name='config' and trashed=false".format(self.data_dir)
+        results = self.drive.files().list(q=query_str, fields="files(id)").execute()
+        if len(results['files']) == 0:
             self.init_data_dir()
             return
-        if len(results['items']) > 1:
+        if len(results['files']) > 1:
             raise AssertionError("config file should be unique")
 
-        fileId = results['items'][0]['id']
-        results = self.drive.files().get_media(fileId=fileId).execute()
+        fileId = results['files'][0]['id']
+        results = _with_backoff(self.drive.files().get_media(fileId=fileId).execute)
         assert results
 
-        self.bd_attr = json.loads(results)
+        self.bd_attr = json_loads(results)
         if self.bd_attr['version'] != Metadata['version']:
             raise AssertionError("Version mismatch: {0} vs {1}", Metadata['version'], self.bd_attr['version'])
 
@@ -199,11 +324,11 @@ class GBD:
         if 'default_block_size' in self.config:
             block_size = int(self.config['default_block_size'])
         else:
-            block_size = int(raw_input("Desired block size: "))
+            block_size = int(input("Desired block size: "))
         if 'default_total_size' in self.config:
             total_size = int(self.config['default_total_size'])
         else:
-            total_size = int(raw_input("Total size: "))
+            total_size = int(input("Total size: "))
         if total_size < block_size:
             raise ValueError("block_size should not be bigger than total_size.")
 
@@ -217,32 +342,74 @@ class GBD:
             'block_count': used_size // block_size,
         }
         body = {
-            'title': 'config',
+            'name': 'config',
             'description': 'config file for gbd',
             'mimeType': 'application/json',
-            'parents': [{'id': self.data_dir}],
+            'parents': [self.data_dir],
         }
-        media_body = MediaInMemoryUpload(json.dumps(self.bd_attr), mimetype='application/json', resumable=False)
+        media_body = MediaInMemoryUpload(json_dumps(self.bd_attr), mimetype='application/json', resumable=False)
+
+        self.drive.files().create(body=body, media_body=media_body, fields="id").execute()
+        self.fresh = True
+
+    def preallocate(self):
+
+        logger.info("Preallocating {0} blocks".format(self.block_count))
+
+        def cb(err, _):
+            if err:
+                logger.error("Preallocation failed: {0}".format(err))
 
-        self.drive.files().insert(body=body, media_body=media_body).execute()
+        items = [(idx, self.ALLOCATE, cb) for idx in range(self.block_count) if self.mapping[idx] is None]
+        self.que.put_many(items, TimedPriorityQueue.PRI_LOW)
+        self.sync()
     
     ## function
 
     def read_block(self, idx, cb=None, pri=TimedPriorityQueue.PRI_NORMAL):
         assert 0 <= idx < self.block_count
-        if cb:
-            self.que.put((idx, None, cb), pri)
-        else:
+        if not cb:
             return self.sync_io(idx, None, pri)
+        item = self.prepare_read(idx, cb, pri)
+        if item:
+            self.que.put(item, pri)
+        self.readahead(idx)
 
     def write_block(self, idx, data, cb=None, pri=TimedPriorityQueue.PRI_NORMAL):
         assert 0 <= idx < self.block_count
         assert data and len(data) == self.block_size
         if cb:
-            self.que.put((idx, data, cb), pri)
+            self.que.put(self.prepare_write(idx, data, cb), pri)
         else:
             return self.sync_io(idx, data, pri)
 
+    def read_blocks(self, indices, cb=None, pri=TimedPriorityQueue.PRI_NORMAL):
+        assert all(0 <= idx < self.block_count for idx in indices)
+        if not cb:
+            return self.sync_io_many(self.read_blocks, indices, pri)
+        if not indices:
+            cb(None, [])
+            return
+        gcb = self.gather(len(indices), cb)
+        items = []
+        for i, idx in enumerate(indices):
+            item = self.prepare_read(idx, gcb(i), pri)
+            if item:
+                items.append(item)
+        self.que.put_many(items, pri)
+
+    def write_blocks(self, blocks, cb=None, pri=TimedPriorityQueue.PRI_NORMAL):
+        assert all(0 <= idx < self.block_count for idx, _ in blocks)
+        assert all(data and len(data) == self.block_size for _, data in blocks)
+        if not cb:
+            return self.sync_io_many(self.write_blocks, blocks, pri)
+        if not blocks:
+            cb(None, [])
+            return
+        gcb = self.gather(len(blocks), cb)
+        items = [self.prepare_write(idx, data, gcb(i)) for i, (idx, data) in enumerate(blocks)]
+        self.que.put_many(items, pri)
+
     def sync(self):
         logger.info("Syncing...")
         self.que.join()
@@ -250,51 +417,276 @@ class GBD:
     def end(self, force):
         if not force:
             self.sync()
+        self.save_state()
         logger.info("End GBD")
 
     ## helper
 
     @classmethod
     def idx_to_name(cls, idx):
-        return "gbd_b" + str(idx)
+        return cls.BLOCK_PREFIX + str(idx)
+
+    def state_file(self):
+        if not self.config.get('state_dir'):
+            return None
+        state_dir = os.path.expanduser(self.config['state_dir'])
+        name = hashlib.sha1(self.config['gbd_data_folder'].encode('utf-8')).hexdigest()
+        return os.path.join(state_dir, name + '.json')
+
+    def load_state(self):
+        path = self.state_file()
+        if not path or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as fin:
+                state = json_loads(fin.read())
+            bd_attr = state['bd_attr']
+            if bd_attr['version'] != Metadata['version']:
+                raise ValueError("version mismatch")
+            if not isinstance(state['data_dir'], str):
+                raise TypeError("data_dir is not a string")
+            if len(state['mapping']) != bd_attr['block_count'] or bd_attr['block_size'] <= 0:
+                raise ValueError("inconsistent block layout")
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring local state {0}: {1}".format(path, repr(e)))
+            return None
+        logger.info("Loaded local state from {0}".format(path))
+        return state
+
+    def save_state(self):
+        path = self.state_file()
+        if not path:
+            return
+        with self._map_lock:
+            mapping = list(self.mapping)
+        state = {
+            'data_dir': self.data_dir,
+            'bd_attr': self.bd_attr,
+            'mapping': mapping,
+        }
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'wb') as fout:
+                fout.write(json_dumps(state))
+            os.replace(path + '.tmp', path)
+        except (IOError, OSError) as e:
+            logger.warning("Can't save local state {0}: {1}".format(path, e))
+
+    def forget_block(self, idx, blkid):
+        with self._map_lock:
+            # another request may already have dropped or replaced this id
+            if self.mapping[idx] != blkid:
+                return
+            self.mapping[idx] = None
+        logger.warning("Block {0} vanished, dropping cached id".format(idx))
+        path = self.state_file()
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.verify_data_dir()
+
+    def verify_data_dir(self):
+        with self.data_dir_lock:
+            if self.data_dir_verified:
+                return
+            folder = self.config['gbd_data_folder']
+            try:
+                item = _with_backoff(self.drive.files().get(fileId=self.data_dir, fields="id,trashed").execute)
+            except apierrors.HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                item = None
+            if not item or item.get('trashed'):
+                raise RuntimeError("Can't locate `{0}' (local state is stale)".format(folder))
+            self.data_dir_verified = True
+
+    def _prime_mapping(self):
+
+        prefix = self.BLOCK_PREFIX
+        query_str = "'{0}' in parents and trashed=false".format(self.data_dir)
+        files = self.drive.files()
+        request = files.list(q=query_str, fields="nextPageToken,files(id,name,createdTime)", pageSize=1000)
+        found = collections.defaultdict(list)
+        while request is not None:
+            results = _with_backoff(request.execute)
+            for item in results.get('files', []):
+                name = item['name']
+                suffix = name[len(prefix):]
+                if not name.startswith(prefix) or not suffix.isdigit():
+                    continue
+                idx = int(suffix)
+                if 0 <= idx < self.block_count:
+                    found[idx].append(item)
+            request = files.list_next(request, results)
+        for idx, items in found.items():
+            self.mapping[idx] = self.pick_block(idx, items)
+
+    def pick_block(self, idx, items):
+        # duplicates can be left behind by a create that failed after landing;
+        # always settle on the oldest copy so every lookup agrees
+        if len(items) > 1:
+            logger.warning("Block `{0}' is not unique ({1} copies), using the oldest".format(self.idx_to_name(idx), len(items)))
+        return min(items, key=lambda x: (x.get('createdTime', ''), x['id']))['id']
 
     def block_id(self, idx):
-        with self.lock:
-            if idx >= self.block_count or idx < 0:
-                raise IndexError("Can't map idx {0}".format(idx))
+        if idx >= self.block_count or idx < 0:
+            raise IndexError("Can't map idx {0}".format(idx))
+        blkid = self.mapping[idx]
+        if blkid is not None:
+            return blkid
+        with self.locks[idx % self.LOCK_STRIPES]:
             if self.mapping[idx] is None:
-                query_str = "title='{0}'".format(self.idx_to_name(idx))
-                results = self.drive.children().list(folderId=self.data_dir, q=query_str).execute()
-                if len(results['items']) == 1:
-                    self.mapping[idx] = results['items'][0]['id']
-                else:
-                    assert len(results['items']) == 0
+                query_str = "'{0}' in parents and name='{1}' and trashed=false".format(self.data_dir, self.idx_to_name(idx))
+                results = _with_backoff(self.drive.files().list(q=query_str, fields="files(id,createdTime)").execute)
+                if results['files']:
+                    with self._map_lock:
+                        self.mapping[idx] = self.pick_block(idx, results['files'])
             return self.mapping[idx]
 
+    def allocate_block(self, idx, recheck):
+        # a create that failed with a 5xx may still have landed on the server
+        if recheck and self.block_id(idx) is not None:
+            return None
+        return self.new_block(idx)
+
     def new_block(self, idx, data=None):
 
-        with self.lock:
+        if idx >= self.block_count or idx < 0:
+            raise ValueError("Index out of bound")
+
+        with self.locks[idx % self.LOCK_STRIPES]:
 
-            if idx >= self.block_count or idx < 0:
-                raise ValueError("Index out of bound")
             if self.mapping[idx] is not None:
                 raise ValueError("None empty mapping @ {0}".format(idx))
             if data is not None:
                 assert len(data) == self.block_size
             else:
-                data = "\0" * self.block_size
+                data = self.zero_block
 
             body = {
-                'title': self.idx_to_name(idx),
+                'name': self.idx_to_name(idx),
                 'mimeType': self.BLOCK_MIMETYPE,
-                'parents': [{'id': self.data_dir}],
+                'parents': [self.data_dir],
             }
-            media_body = MediaInMemoryUpload(data, mimetype=self.BLOCK_MIMETYPE, resumable=False)
-
-            result = self.drive.files().insert(body=body, media_body=media_body).execute()
-            self.mapping[idx] = result['id']
+            media_body = self.media_body(data)
+            result = _upload(self.drive.files().create(body=body, media_body=media_body, fields="id"))
+            with self._map_lock:
+                self.mapping[idx] = result['id']
             return result
 
+    def media_body(self, data):
+        resumable = self.block_size > self.RESUMABLE_THRESHOLD
+        chunksize = min(self.block_size, self.UPLOAD_CHUNKSIZE) if resumable else self.block_size
+        # BytesIO shares the buffer of a bytes payload (e.g. the zero block)
+        # instead of copying it
+        return MediaIoBaseUpload(BytesIO(data), mimetype=self.BLOCK_MIMETYPE, chunksize=chunksize, resumable=resumable)
+
+    def readahead(self, idx):
+
+        depth = self.config['readahead']
+        if depth <= 0 or self._cache_size <= 0:
+            return
+
+        with self._inflight_lock:
+            self._last_reads.append(idx)
+            history = list(self._last_reads)
+        if len(history) < self._last_reads.maxlen:
+            return
+        if any(b != a + 1 for a, b in zip(history, history[1:])):
+            return
+
+        def noop(err, data):
+            pass
+
+        items = []
+        for nidx in range(idx + 1, min(idx + 1 + depth, self.block_count)):
+            item = self.prepare_read(nidx, noop, TimedPriorityQueue.PRI_LOW)
+            if item:
+                items.append(item)
+        self.que.put_many(items, TimedPriorityQueue.PRI_LOW)
+
+    def prepare_read(self, idx, cb, pri):
+        data = self.cache_get(idx)
+        if data is not None:
+            cb(None, data)
+            return None
+        with self._inflight_lock:
+            entry = self._inflight_reads.get(idx)
+            if entry is not None:
+                entry['waiters'].append(cb)
+                if entry['started'] or pri >= entry['pri']:
+                    return None
+                # still queued at a lower priority, queue it again at ours;
+                # whichever copy a worker picks first wins, see start_read
+                entry['pri'] = pri
+                return (idx, None, entry['cb'])
+            entry = self._inflight_reads[idx] = {'waiters': [cb], 'pri': pri, 'started': False}
+            entry['cb'] = self.read_done(idx, entry)
+            return (idx, None, entry['cb'])
+
+    def start_read(self, cb):
+        entry = getattr(cb, 'entry', None)
+        if entry is None:
+            return True
+        with self._inflight_lock:
+            if entry['started']:
+                return False
+            entry['started'] = True
+            return True
+
+    def prepare_write(self, idx, data, cb):
+        with self._inflight_lock:
+            self._inflight_reads.pop(idx, None)
+        self.cache_pop(idx)
+        return (idx, data, self.write_done(idx, cb))
+
+    def read_done(self, idx, entry):
+        def cb(err, data):
+            with self._inflight_lock:
+                if self._inflight_reads.get(idx) is entry:
+                    del self._inflight_reads[idx]
+                    if not err:
+                        self.cache_put(idx, data)
+            for waiter in entry['waiters']:
+                try:
+                    waiter(err, data)
+                except Exception as e:
+                    logger.error("Callback failed: {0}".format(repr(e)))
+        cb.entry = entry
+        return cb
+
+    def write_done(self, idx, cb):
+        def mycb(err, data):
+            # a read issued while the write was in flight may have been
+            # answered before it landed; don't let it fill the cache
+            with self._inflight_lock:
+                self._inflight_reads.pop(idx, None)
+                self.cache_pop(idx)
+            cb(err, data)
+        return mycb
+
+    def cache_get(self, idx):
+        with self._cache_lock:
+            data = self._cache.get(idx)
+            if data is not None:
+                self._cache.move_to_end(idx)
+            return data
+
+    def cache_put(self, idx, data):
+        if self._cache_size <= 0:
+            return
+        with self._cache_lock:
+            self._cache[idx] = data
+            self._cache.move_to_end(idx)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def cache_pop(self, idx):
+        with self._cache_lock:
+            self._cache.pop(idx, None)
+
     def sync_io(self, idx, data, pri):
 
         ret = []
@@ -303,7 +695,27 @@ class GBD:
             ret.append(param)
             sem.release()
 
-        self.que.put((idx, data, mycb), pri)
+        if data is None:
+            self.read_block(idx, mycb, pri)
+        else:
+            self.write_block(idx, data, mycb, pri)
+        sem.acquire()
+
+        err, data = ret.pop()
+        if err:
+            raise err
+        else:
+            return data
+
+    def sync_io_many(self, submit, blocks, pri):
+
+        ret = []
+        sem = Semaphore(0)
+        def mycb(*param):
+            ret.append(param)
+            sem.release()
+
+        submit(blocks, mycb, pri)
         sem.acquire()
 
         err, data = ret.pop()
@@ -311,3 +723,26 @@ class GBD:
             raise err
         else:
             return data
+
+    def gather(self, count, cb):
+
+        lock = Lock()
+        results = [None] * count
+        errors = []
+        state = [count]
+
+        def gcb(i):
+            def mycb(err, data):
+                with lock:
+                    if err:
+                        errors.append(err)
+                    results[i] = data
+                    state[0] -= 1
+                    if state[0] != 0:
+                        return
+                if errors:
+                    cb(errors[0], None)
+                else:
+                    cb(None, results)
+            return mycb
+        return gcb
@@ -1,6 +1,6 @@
 #!/usr/bin/python2
 
-import time
+import itertools
 from queue import PriorityQueue
 from threading import Condition
 
@@ -12,9 +12,19 @@ class TimedPriorityQueue(PriorityQueue):
 
     def __init__(self, *args, **kargs):
         PriorityQueue.__init__(self, *args, **kargs)
+        # ties are broken by arrival order; never by comparing the items
+        self.counter = itertools.count()
 
     def put(self, item, priority=PRI_NORMAL):
-        PriorityQueue.put(self, (priority, time.time(), item))
+        PriorityQueue.put(self, (priority, next(self.counter), item))
+
+    def put_many(self, items, priority=PRI_NORMAL):
+        assert self.maxsize <= 0
+        with self.mutex:
+            for item in items:
+                self._put((priority, next(self.counter), item))
+            self.unfinished_tasks += len(items)
+            self.not_empty.notify(len(items))
 
     def get(self, *args, **kargs):
         _, _, item = PriorityQueue.get(self, *args, **kargs)